@@ -2,11 +2,13 @@ import os
 import re
 import csv
 import tempfile
-import PyPDF2
 from flask import Flask, render_template, request, jsonify, send_file
-from pdf2image import convert_from_path
-import pytesseract
-import shutil
+from io import BytesIO, StringIO
+import threading
+import functools
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 app = Flask(__name__)
 
@@ -14,9 +16,90 @@ app = Flask(__name__)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 POPPLER_PATH = os.path.join(BASE_DIR, 'poppler', 'bin')
 TESSERACT_CMD = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+TESSDATA_PATH = os.path.join(os.path.dirname(TESSERACT_CMD), 'tessdata', '')
 
-# Set Tesseract command
-pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+# LSTM engine only, single uniform block of text, keep runs of spaces between words
+TESS_CONFIG = '--oem 1 --psm 6 -c preserve_interword_spaces=1'
+
+# Pages sampled to tell born-digital PDFs from scans, and the text needed to count as a text layer
+TEXT_LAYER_SAMPLE_PAGES = 3
+MIN_TEXT_LAYER_CHARS = 20
+
+# Tesseract is multi-threaded itself, so give each OCR process about 4 cores
+OCR_WORKERS = max(1, (os.cpu_count() or 1) // 4)
+
+# Pages rasterized per poppler call; bounds how many page images are held in memory
+OCR_BATCH_PAGES = 16
+# pdftoppm processes pdf2image may start in parallel for one batch
+RASTER_THREADS = os.cpu_count() or 1
+
+# OCR worker processes, shared across requests so each keeps its loaded trained data
+_ocr_pool = None
+_ocr_pool_lock = threading.Lock()
+
+# tesserocr API instances by language; Tesseract state is not thread-safe, so one set per thread
+_tess_local = threading.local()
+
+# Common TOC line patterns for both languages
+COMMON_PATTERNS = tuple(re.compile(p, re.IGNORECASE | re.UNICODE) for p in [
+    r'^(?P<chapter>.*?)[\s\.\-]+(?P<page>\d+)\s*$',          # Title........123
+    r'^(?P<chapter>.*?)[\s\-\_]+(?P<page>\d+)\s*$',           # Title - 123
+    r'^\s*(?P<chapter>\d+\..*?)[\s\.\-]+(?P<page>\d+)\s*$',  # 1. Title...123
+])
+
+# Hindi-specific patterns - improved for Hindi TOC structures
+HINDI_PATTERNS = tuple(re.compile(p, re.IGNORECASE | re.UNICODE) for p in [
+    # Hindi numbering: १. शीर्षक १२३
+    r'^\s*(?P<chapter>[०१२३४५६७८९]+\.\s+.*?)[\s\.\-]*(?P<page>[०१२३४५६७८९\d]+)\s*$',
+    # Hindi with separator: शीर्षक - १२३
+    r'^(?P<chapter>.*?)[\s\-\—]+(?P<page>[०१२३४५६७८९\d]+)\s*$',
+    # Hindi with dots: शीर्षक........१२३
+    r'^(?P<chapter>.*?)[\s\.]+(?P<page>[०१२३४५६७८९\d]+)\s*$',
+    # Chapter headings: अध्याय १: शीर्षक १२३
+    r'^(?P<chapter>.*?(?:अध्याय|खंड|परिशिष्ट|प्रस्तावना|भाग|अनुभाग|प्रकरण)\s*[०१२३४५६७८९]*[\.\:\-]?\s*.*?)[\s\.\-]*(?P<page>[०१२३४५६७८९\d]+)\s*$',
+    # Generic Hindi: any text followed by Hindi/Arabic digits at the end
+    r'^(?P<chapter>.*?)\s+(?P<page>[०१२३४५६७८९\d]+)$',
+])
+
+def _fuse_patterns(patterns):
+    """Combine line patterns into one alternation, numbering each chapter/page group pair"""
+    return re.compile('|'.join(
+        '(?:%s)' % pattern.pattern
+        .replace('(?P<chapter>', f'(?P<chapter{i}>')
+        .replace('(?P<page>', f'(?P<page{i}>')
+        for i, pattern in enumerate(patterns)
+    ), re.IGNORECASE | re.UNICODE)
+
+# TOC line patterns for each upload language option
+PATTERNS_BY_LANG = {
+    'eng': COMMON_PATTERNS,
+    'hin': HINDI_PATTERNS,
+    'both': HINDI_PATTERNS + COMMON_PATTERNS,  # Hindi first, as before; English only adds matches
+}
+
+# One regex engine call per line instead of trying each pattern in turn
+TOC_RE_BY_LANG = {lang: _fuse_patterns(patterns) for lang, patterns in PATTERNS_BY_LANG.items()}
+
+# TOC headers to skip for each upload language option
+SKIP_TERMS_ENG = ("table of contents", "contents", "page", "chap")
+SKIP_TERMS_HINDI = ("विषय सूची", "अनुक्रमणिका", "सामग्री", "पृष्ठ", "अध्याय")
+SKIP_TERMS_BY_LANG = {
+    'eng': SKIP_TERMS_ENG,
+    'hin': SKIP_TERMS_HINDI,
+    'both': SKIP_TERMS_HINDI,
+}
+
+# Longest line considered as a TOC entry
+MAX_TOC_LINE_LENGTH = 200
+
+# Translation table from Hindi (Devanagari) digits to Arabic numerals
+_HINDI_TRANS = str.maketrans('०१२३४५६७८९', '0123456789')
+
+# Page numbers: Arabic or Hindi digits only
+_PAGE_RE = re.compile(r'\A[0-9०१२३४५६७८९]+\Z')
+
+# Fallback: digits at the end of the line
+FALLBACK_DIGITS = re.compile(r'(\d+|[०१२३४५६७८९]+)$')
 
 def get_poppler_path():
     """Get poppler path from the project directory"""
@@ -24,128 +107,230 @@ def get_poppler_path():
 
 def convert_hindi_digits(text):
     """Convert Hindi (Devanagari) digits to Arabic numerals"""
-    hindi_digits = {
-        '०': '0', '१': '1', '२': '2', '३': '3', '४': '4',
-        '५': '5', '६': '6', '७': '7', '८': '8', '९': '9'
-    }
-    return ''.join(hindi_digits.get(char, char) for char in text)
+    return text.translate(_HINDI_TRANS)
+
+# OCR libraries are imported on first use so workers that never OCR skip the cost
+@functools.lru_cache(maxsize=None)
+def _lazy_tess():
+    """Import pytesseract and point it at the Tesseract binary"""
+    import pytesseract
+    pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+    return pytesseract
+
+@functools.lru_cache(maxsize=None)
+def _lazy_tesserocr():
+    """Import tesserocr, or return None to fall back to pytesseract"""
+    try:
+        import tesserocr
+    except ImportError:
+        return None
+    return tesserocr
+
+def get_tess_api(lang):
+    """Get the in-process Tesseract API for a language, loading its trained data once"""
+    apis = getattr(_tess_local, 'apis', None)
+    if apis is None:
+        apis = _tess_local.apis = {}
+    api = apis.get(lang)
+    if api is None:
+        tesserocr = _lazy_tesserocr()
+        options = {'lang': lang, 'psm': tesserocr.PSM.SINGLE_BLOCK, 'oem': tesserocr.OEM.LSTM_ONLY}
+        if os.path.isdir(TESSDATA_PATH):
+            options['path'] = TESSDATA_PATH
+        api = apis[lang] = tesserocr.PyTessBaseAPI(**options)
+        api.SetVariable('preserve_interword_spaces', '1')
+    return api
+
+def ocr_image(image, lang):
+    """OCR a rasterized page image (runs in a worker process)"""
+    try:
+        if _lazy_tesserocr() is not None:
+            api = get_tess_api(lang)
+            api.SetImage(image)
+            return api.GetUTF8Text()
+        
+        # Use specified language for OCR
+        return _lazy_tess().image_to_string(image, lang=lang, config=TESS_CONFIG)
+    except Exception as e:
+        # Some OCR errors (e.g. TesseractNotFoundError) can't be unpickled in the
+        # parent and would break the whole pool, so send back a plain error instead
+        raise RuntimeError(str(e)) from None
 
-def extract_text_from_pdf(pdf_path, lang='eng'):
+def get_ocr_pool():
+    """Get the shared OCR worker pool, starting it on first use"""
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is None:
+            _ocr_pool = ProcessPoolExecutor(max_workers=OCR_WORKERS)
+        return _ocr_pool
+
+def discard_ocr_pool(pool):
+    """Drop a pool whose worker died so the next request starts a fresh one"""
+    global _ocr_pool
+    with _ocr_pool_lock:
+        if _ocr_pool is not pool:
+            return  # Already replaced by another request
+        _ocr_pool = None
+    pool.shutdown(wait=False)
+
+def page_runs(page_nums, max_len=OCR_BATCH_PAGES):
+    """Group sorted page numbers into (first, last) runs of consecutive pages"""
+    runs = []
+    for page_num in page_nums:
+        if runs and page_num == runs[-1][1] + 1 and page_num - runs[-1][0] < max_len:
+            runs[-1][1] = page_num
+        else:
+            runs.append([page_num, page_num])
+    return runs
+
+def extract_text_from_pdf(pdf_data, lang='eng'):
     """Extract text from PDF using PyPDF2 with OCR fallback"""
-    text = ""
-    poppler_path = get_poppler_path()
+    import PyPDF2
+    
+    reader = PyPDF2.PdfReader(BytesIO(pdf_data))
+    pages = iter(reader.pages)
+    
+    # Sample the first pages to decide up front whether the text layer is usable
+    page_texts = [page.extract_text() for page in islice(pages, TEXT_LAYER_SAMPLE_PAGES)]
+    has_text = [len(page_text.strip()) >= MIN_TEXT_LAYER_CHARS for page_text in page_texts]
     
-    with open(pdf_path, 'rb') as file:
-        reader = PyPDF2.PdfReader(file)
-        num_pages = len(reader.pages)
-        for page_num in range(num_pages):
-            page = reader.pages[page_num]
-            page_text = page.extract_text()
-            if not page_text.strip():
-                # Use OCR for the page
+    if page_texts and not any(page_text.strip() for page_text in page_texts):
+        # No text layer at all: OCR every page, reading the rest of the text layer only if OCR fails
+        page_texts += [None] * (len(reader.pages) - len(page_texts))
+        ocr_pages = list(range(len(reader.pages)))
+    else:
+        page_texts.extend(page.extract_text() for page in pages)
+        if all(has_text):
+            # Born-digital document: trust the text layer, even on blank pages
+            ocr_pages = []
+        else:
+            ocr_pages = [page_num for page_num, page_text in enumerate(page_texts) if not page_text.strip()]
+    
+    # Pages without a text layer are OCR'd in parallel, one page per task
+    if ocr_pages:
+        from pdf2image import convert_from_path
+        poppler_path = get_poppler_path()
+        
+        # poppler reads from disk, so write the PDF out once for every OCR batch
+        fd, pdf_path = tempfile.mkstemp(suffix='.pdf')
+        try:
+            with os.fdopen(fd, 'wb') as pdf_file:
+                pdf_file.write(pdf_data)
+            
+            # Rasterize each run of consecutive pages with a single poppler call
+            for first, last in page_runs(ocr_pages):
                 try:
                     images = convert_from_path(
                         pdf_path, 
-                        first_page=page_num+1, 
-                        last_page=page_num+1,
+                        first_page=first+1, 
+                        last_page=last+1,
                         poppler_path=poppler_path,
-                        dpi=400,  # Higher DPI for better Hindi OCR
-                        grayscale=True  # Better for text recognition
+                        dpi=300,  # Tesseract's recommended resolution
+                        grayscale=True,  # Better for text recognition
+                        thread_count=RASTER_THREADS
                     )
-                    if images:
-                        # Use specified language for OCR
-                        config = '--psm 6'  # Assume a single uniform block of text
-                        page_text = pytesseract.image_to_string(images[0], lang=lang, config=config)
                 except Exception as e:
-                    print(f"OCR failed on page {page_num+1}: {str(e)}")
-                    page_text = ""  # Use empty string if OCR fails
-            text += page_text + "\n"
-    return text
+                    print(f"OCR failed on pages {first+1}-{last+1}: {str(e)}")
+                    images = []
+            
+                futures = {}
+                if images:
+                    pool = get_ocr_pool()
+                    try:
+                        for page_num, image in zip(range(first, last+1), images):
+                            futures[page_num] = pool.submit(ocr_image, image, lang)
+                    except BrokenProcessPool as e:
+                        # Pages not yet submitted are left empty; the next run gets a fresh pool
+                        print(f"OCR failed on pages {first+1}-{last+1}: {str(e)}")
+                        discard_ocr_pool(pool)
+                for page_num in range(first, last+1):
+                    ocr_text = ""
+                    try:
+                        if page_num in futures:
+                            ocr_text = futures[page_num].result()
+                    except BrokenProcessPool as e:
+                        # A worker process died; the next run starts a fresh pool
+                        print(f"OCR failed on page {page_num+1}: {str(e)}")
+                        discard_ocr_pool(pool)
+                    except Exception as e:
+                        # OCR errors (e.g. tesseract not installed) only fail their own page
+                        print(f"OCR failed on page {page_num+1}: {str(e)}")
+                    
+                    # Keep whatever the text layer has if OCR failed or found nothing
+                    if not ocr_text.strip():
+                        ocr_text = page_texts[page_num]
+                        if ocr_text is None:
+                            ocr_text = reader.pages[page_num].extract_text()
+                    page_texts[page_num] = ocr_text
+        finally:
+            os.remove(pdf_path)
+    
+    return "\n".join(page_texts) + "\n"
 
 def is_valid_page_number(page_str):
     """Check if string contains only digits (Arabic or Hindi)"""
-    if not page_str:
-        return False
     # Check for Arabic digits (0-9) or Hindi digits (०-९)
-    return all(char in '0123456789०१२३४५६७८९' for char in page_str)
+    return bool(page_str) and _PAGE_RE.match(page_str) is not None
 
-def parse_toc(text, is_hindi=False):
+def parse_toc(text, lang='eng'):
     """Parse the table of contents from extracted text"""
     entries = []
+    if not text.strip():
+        return entries  # Nothing extracted, e.g. every OCR page failed
     
-    # Common patterns for both languages
-    common_patterns = [
-        r'^(.*?)[\s\.\-]+(\d+)\s*$',          # Title........123
-        r'^(.*?)[\s\-\_]+(\d+)\s*$',           # Title - 123
-        r'^\s*(\d+\..*?)[\s\.\-]+(\d+)\s*$',  # 1. Title...123
-    ]
+    # Unknown languages are parsed as English
+    if lang not in TOC_RE_BY_LANG:
+        lang = 'eng'
+    toc_re = TOC_RE_BY_LANG[lang]
+    skip_terms = SKIP_TERMS_BY_LANG[lang]
     
-    # Hindi-specific patterns - improved for Hindi TOC structures
-    hindi_patterns = [
-        # Hindi numbering: १. शीर्षक १२३
-        r'^\s*([०१२३४५६७८९]+\.\s+.*?)[\s\.\-]*([०१२३४५६७८९\d]+)\s*$',
-        # Hindi with separator: शीर्षक - १२३
-        r'^(.*?)[\s\-\—]+([०१२३४५६७८९\d]+)\s*$',
-        # Hindi with dots: शीर्षक........१२३
-        r'^(.*?)[\s\.]+([०१२३४५६७८९\d]+)\s*$',
-        # Chapter headings: अध्याय १: शीर्षक १२३
-        r'^(.*?(?:अध्याय|खंड|परिशिष्ट|प्रस्तावना|भाग|अनुभाग|प्रकरण)\s*[०१२३४५६७८९]*[\.\:\-]?\s*.*?)[\s\.\-]*([०१२३४५६७८९\d]+)\s*$',
-        # Generic Hindi: any text followed by Hindi/Arabic digits at the end
-        r'^(.*?)\s+([०१२३४५६७८९\d]+)$'
-    ]
-    
-    patterns = hindi_patterns if is_hindi else common_patterns
-    
-    # Skip terms
-    skip_terms_eng = ["table of contents", "contents", "page", "chap"]
-    skip_terms_hindi = ["विषय सूची", "अनुक्रमणिका", "सामग्री", "पृष्ठ", "अध्याय"]
-    skip_terms = skip_terms_hindi if is_hindi else skip_terms_eng
-    
-    for line in text.split('\n'):
+    for line in text.splitlines():
         line = line.strip()
         if not line or len(line) < 5:
             continue
         
+        # Real TOC entries are short; long OCR noise only feeds regex backtracking
+        if len(line) > MAX_TOC_LINE_LENGTH:
+            continue
+        
+        # Every pattern needs a trailing page number (isdigit also covers Hindi digits)
+        if not line[-1].isdigit():
+            continue
+        
         # Skip common TOC headers
-        if any(term in line.lower() for term in skip_terms):
+        lowered = line.lower()
+        if any(term in lowered for term in skip_terms):
             continue
             
-        for pattern in patterns:
-            match = re.match(pattern, line, re.IGNORECASE | re.UNICODE)
-            if match:
-                # Handle different group patterns
-                if len(match.groups()) == 2:
-                    chapter = match.group(1).strip()
-                    page = match.group(2).strip()
-                elif len(match.groups()) == 3:
-                    # For patterns with 3 groups (like numbered headings)
-                    chapter = f"{match.group(1)} {match.group(2)}".strip()
-                    page = match.group(3).strip()
-                else:
-                    continue
-                
-                # Validate page number (Arabic or Hindi digits)
+        match = toc_re.match(line)
+        if not match:
+            continue
+
+        # The page group closes last, so it identifies which pattern matched
+        page_group = match.lastgroup
+        chapter = match.group('chapter' + page_group[len('page'):]).strip()
+        page = match.group(page_group).strip()
+
+        # Validate page number (Arabic or Hindi digits)
+        if is_valid_page_number(page):
+            # Convert Hindi digits to Arabic numerals
+            page = convert_hindi_digits(page)
+            entries.append({
+                "chapter": chapter,
+                "page": page
+            })
+        else:
+            # Fallback: Look for digits at the end of the line
+            digit_match = FALLBACK_DIGITS.search(line)
+            if digit_match:
+                page = digit_match.group(1)
                 if is_valid_page_number(page):
-                    # Convert Hindi digits to Arabic numerals
+                    chapter = line[:digit_match.start()].strip()
                     page = convert_hindi_digits(page)
                     entries.append({
                         "chapter": chapter,
                         "page": page
                     })
-                    break
-                else:
-                    # Fallback: Look for digits at the end of the line
-                    digit_match = re.search(r'(\d+|[०१२३४५६७८९]+)$', line)
-                    if digit_match:
-                        page = digit_match.group(1)
-                        if is_valid_page_number(page):
-                            chapter = line[:digit_match.start()].strip()
-                            page = convert_hindi_digits(page)
-                            entries.append({
-                                "chapter": chapter,
-                                "page": page
-                            })
-                            break
     
     return entries
 
@@ -164,24 +349,20 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
     
-    # Create a temporary directory
-    temp_dir = tempfile.mkdtemp()
-    pdf_path = os.path.join(temp_dir, file.filename)
-    file.save(pdf_path)
+    # Keep the upload in memory rather than saving it to disk
+    pdf_data = file.read()
     
     try:
-        # Determine if we need Hindi-specific parsing
-        is_hindi = (language == 'hin' or language == 'both')
         # For OCR, we can pass the language code. If both, we pass 'eng+hin'
         ocr_lang = language
         if language == 'both':
             ocr_lang = 'eng+hin'
         
         # Extract text from PDF
-        text = extract_text_from_pdf(pdf_path, lang=ocr_lang)
+        text = extract_text_from_pdf(pdf_data, lang=ocr_lang)
         
         # Parse TOC from text
-        toc = parse_toc(text, is_hindi=is_hindi)
+        toc = parse_toc(text, lang=language)
         return jsonify({
             'status': 'success',
             'toc': toc,
@@ -189,9 +370,6 @@ def upload_file():
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        # Clean up
-        shutil.rmtree(temp_dir, ignore_errors=True)
 
 @app.route('/download', methods=['POST'])
 def download_csv():
@@ -199,23 +377,17 @@ def download_csv():
     if not data or not data.get('toc'):
         return jsonify({'error': 'No TOC data provided'}), 400
     
-    # Create a temporary CSV file
-    temp_dir = tempfile.mkdtemp()
-    csv_path = os.path.join(temp_dir, 'toc.csv')
-    
+    # Build the CSV in memory
     try:
-        with open(csv_path, 'w', newline='', encoding='utf-8-sig') as csvfile:  # UTF-8 with BOM for Excel
-            writer = csv.writer(csvfile)
-            writer.writerow(['Chapter Name', 'Page Number'])
-            for item in data['toc']:
-                writer.writerow([item['chapter'], item['page']])
+        csvfile = StringIO(newline='')
+        writer = csv.writer(csvfile)
+        writer.writerow(['Chapter Name', 'Page Number'])
+        writer.writerows((item['chapter'], item['page']) for item in data['toc'])
         
-        return send_file(csv_path, as_attachment=True, download_name='table_of_contents.csv')
+        csv_data = BytesIO(csvfile.getvalue().encode('utf-8-sig'))  # UTF-8 with BOM for Excel
+        return send_file(csv_data, mimetype='text/csv', as_attachment=True, download_name='table_of_contents.csv')
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        # Clean up after sending the file
-        shutil.rmtree(temp_dir, ignore_errors=True)
 
 if __name__ == '__main__':
     # Verify poppler installation